@@ -1,17 +1,25 @@
 from __future__ import annotations
 
+import re
 from argparse import ArgumentParser, FileType
 from dataclasses import dataclass
-from io import StringIO
 from typing import Tuple, List, Any, TextIO, Dict, Iterator, Optional, TypedDict
 
 import yaml
-from jinja2 import Environment, TemplateSyntaxError
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, Template, TemplateSyntaxError
 
 from make_ssh_config.util import CIDict, dict_gets
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 display = print
 
+# A str starting with "{{" and ending with "}}", capturing the stripped inner text
+_EXPRESSION_RE = re.compile(r'\{\{\s*(.*\S)\s*\}\}', re.DOTALL)
+
 
 def warning(*args, **kwargs):
     import sys
@@ -32,7 +40,11 @@ def yaml_str_list(o) -> List[str]:
     else:
         r = []
         for s in o:
-            r.extend(yaml_str_list(s))
+            # Most lists are flat; only recurse into nested ones
+            if isinstance(s, str):
+                r.append(s)
+            elif s is not None:
+                r.extend(yaml_str_list(s))
         return r
 
 
@@ -42,19 +54,19 @@ def merge_config(a, b) -> CIDict:
 
     keys whose value are None is popped
     """
-    o = CIDict()
+    if not isinstance(a, CIDict):
+        a = CIDict(a)
 
-    for k, v in a.items():
-        if v is not None:
-            o[k] = v
+    if not isinstance(b, CIDict):
+        b = CIDict(b)
 
-    for k, v in b.items():
-        if v is None:
-            o.pop(k)
-        else:
-            o[k] = v
+    keys = {**a._keys, **b._keys}
+    values = {**a._values, **b._values}
+
+    for k in [k for k, v in values.items() if v is None]:
+        del keys[k], values[k]
 
-    return o
+    return CIDict._from_raw(keys, values)
 
 
 class Keyword:
@@ -73,11 +85,17 @@ class MatchDict(TypedDict):
 
 @dataclass
 class Layer:
+    # Declared by hand since dataclass(slots=True) needs Python 3.10; the fields have no defaults
+    __slots__ = ('config', 'vars', 'host', 'match')
+
     config: CIDict[str, Any]
     vars: Dict[str, Any]
     host: Optional[List[str]]
     match: Optional[MatchDict]
 
+    # Match criteria taking a pattern list, in output order
+    _MATCH_LIST_KEYS = ('host', 'originalhost', 'user', 'localuser')
+
     def __post_init__(self):
         if self.host is not None and self.match is not None:
             raise ValueError
@@ -101,48 +119,43 @@ class Layer:
         if self.host is not None:
             return 'Host %s\n' % ' '.join(self.host)
         elif self.match is not None:
-            all_, canonical, exec_, host, originalhost, user, localuser = dict_gets(
-                self.match,
-                'all', 'canonical', 'exec', 'host', 'originalhost', 'user', 'localuser',
-            )
+            match = self.match
+            all_, canonical, exec_ = dict_gets(match, 'all', 'canonical', 'exec')
 
-            if all_ and (canonical or exec_ or host or originalhost or user or localuser):
+            if all_ and (canonical or exec_ or any(match.get(key) for key in self._MATCH_LIST_KEYS)):
                 raise ValueError("The 'all' token must be alone or immediately after 'canonical'")
 
-            args = []
-
-            if canonical:
-                args.append('canonical')
+            args = ['canonical'] if canonical else []
 
             if all_:
                 args.append('all')
 
-            if host:
-                args.extend(('host', ','.join(host)))
-
-            if originalhost:
-                args.extend(('originalhost', ','.join(originalhost)))
-
-            if user:
-                args.extend(('user', ','.join(user)))
-
-            if localuser:
-                args.extend(('localuser', ','.join(localuser)))
+            for key in self._MATCH_LIST_KEYS:
+                values = match.get(key)
+                if values:
+                    args.append(key)
+                    args.append(','.join(values))
 
             if exec_:
-                args.extend(('exec', exec_))
+                args.append('exec')
+                args.append(exec_)
 
             return 'Match %s\n' % ' '.join(args)
 
-    def write(self, out: TextIO):
-        """Write this entry to the output"""
+    def render(self) -> str:
+        """Return this entry as text"""
 
-        out.write(self.header_line())
+        parts = [self.header_line()]
 
         for option, value in self.iter_decls():
-            out.write(f'    {option} {maybe_quote(value)}\n')
+            parts.append(f'    {option} {maybe_quote(value)}\n')
+
+        parts.append('\n')
+        return ''.join(parts)
 
-        out.write('\n')
+    def write(self, out: TextIO):
+        """Write this entry to the output"""
+        out.write(self.render())
 
 
 def maybe_quote(s: str):
@@ -152,8 +165,8 @@ def maybe_quote(s: str):
     TODO Check the character escape logic behind OpenSSH?
     """
 
-    parts = s.split()
-    if len(parts) < 2:
+    # At most one split is enough to tell whether there are two or more words
+    if len(s.split(None, 1)) < 2:
         return s
 
     if '"' in s:
@@ -168,14 +181,17 @@ def normalize_host(host) -> List[str]:
     return host
 
 
+_MATCH_KEYS = ('all', 'canonical', 'exec', 'host', 'originalhost', 'user', 'localuser')
+_MATCH_KEY_SET = frozenset(_MATCH_KEYS)
+
+
 def normalize_match(match) -> MatchDict:
-    keys = ('all', 'canonical', 'exec', 'host', 'originalhost', 'user', 'localuser')
-    bad_key = next((k for k in match.keys() if k not in keys), None)
-    if bad_key:
+    bad_keys = match.keys() - _MATCH_KEY_SET
+    if bad_keys:
+        bad_key = next(k for k in match.keys() if k in bad_keys)
         raise ValueError(f"Unknown match key {bad_key!r}")
 
-    all_, canonical, exec_, host, originalhost, user, localuser = dict_gets(match, *keys)
-    del keys, bad_key
+    all_, canonical, exec_, host, originalhost, user, localuser = dict_gets(match, *_MATCH_KEYS)
 
     return MatchDict(
         all=bool(all_),
@@ -188,23 +204,55 @@ def normalize_match(match) -> MatchDict:
     )
 
 
+class SourceLoader(BaseLoader):
+    """
+    Load templates named by their own source
+
+    Jinja only consults the bytecode cache for templates loaded through a loader, not from_string().
+    """
+
+    def get_source(self, environment, template):
+        return template, None, lambda: True
+
+
 class ConfigMaker:
-    def __init__(self):
+    _VALID_RECORD_KEYS = frozenset({
+        'config',
+        'host',
+        'match',
+        'merge',
+        'name',
+        'vars',
+    })
+
+    def __init__(self, jinja_cache_dir: Optional[str] = None):
         self.registry: Dict[str, Layer] = {}
         self.entries: List[Layer] = []
-        self.jinja_env = Environment()
+
+        if jinja_cache_dir is None:
+            self.jinja_env = Environment()
+            load_template = self.jinja_env.from_string
+        else:
+            # Opt-in: persist compiled templates across runs in the given directory
+            self.jinja_env = Environment(
+                loader=SourceLoader(),
+                bytecode_cache=FileSystemBytecodeCache(jinja_cache_dir),
+            )
+            load_template = self.jinja_env.get_template
+
+        # Compiled templates and expressions keyed by their source
+        # An expression which failed to compile is cached as False
+        self._tpl_cache: Dict[str, Template] = {}
+        self._expr_cache: Dict[str, Any] = {}
+        self._merge_cache: Dict[Tuple[str, ...], Tuple[CIDict, Dict[str, Any]]] = {}
+        # Bound once for the cache misses in render_value
+        self._load_template = load_template
+        self._compile_expression = self.jinja_env.compile_expression
 
     def _check_record_keys(self, record):
-        valid = {
-            'config',
-            'host',
-            'match',
-            'merge',
-            'name',
-            'vars',
-        }
-        bad_key = next((k for k in record.keys() if k not in valid), None)
-        if bad_key:
+        bad_keys = record.keys() - self._VALID_RECORD_KEYS
+        if bad_keys:
+            bad_key = next(k for k in record.keys() if k in bad_keys)
             raise ValueError(f"Invalid layer attribute {bad_key}")
 
     def render_value(self, value, locals_, memo: Dict[int, Any] = None):
@@ -216,16 +264,34 @@ class ConfigMaker:
         as Jinja template.
         """
         if isinstance(value, str):
-            if value.startswith('{{') and value.endswith('}}'):
+            # Plain strings render to themselves, except for the newline handling of Jinja
+            if (
+                '{{' not in value and '{%' not in value and '{#' not in value
+                and '\r' not in value and not value.endswith('\n')
+            ):
+                return value
+
+            m = _EXPRESSION_RE.fullmatch(value)
+            if m:
                 # Try to interpret the expr result if possible, fallback to template string
-                try:
-                    tpl_expr = self.jinja_env.compile_expression(value[2:-2])
-                except TemplateSyntaxError:
-                    pass
-                else:
+                source = m.group(1)
+                tpl_expr = self._expr_cache.get(source)
+
+                if tpl_expr is None:
+                    try:
+                        tpl_expr = self._compile_expression(source)
+                    except TemplateSyntaxError:
+                        tpl_expr = False
+
+                    self._expr_cache[source] = tpl_expr
+
+                if tpl_expr is not False:
                     return tpl_expr(locals_)
 
-            template = self.jinja_env.from_string(value)
+            template = self._tpl_cache.get(value)
+            if template is None:
+                template = self._tpl_cache[value] = self._load_template(value)
+
             return template.render(locals_)
         elif isinstance(value, (list, dict)):
             if memo is None:
@@ -236,15 +302,30 @@ class ConfigMaker:
             if id_ in memo:
                 return memo[id_]
 
-            if isinstance(value, list):
-                result = memo[id_] = []
+            # Walk nested containers with an explicit stack instead of recursion.
+            # The memo maps each visited container to its result, preserving shared and cyclic references.
+            result = memo[id_] = [] if isinstance(value, list) else {}
+            stack = [(value, result)]
 
-                for item in value:
-                    result.append(self.render_value(item, locals_, memo=memo))
-            else:
-                result = memo[id_] = {}
-                for key, val in value.items():
-                    result[key] = self.render_value(val, locals_, memo=memo)
+            while stack:
+                source, target = stack.pop()
+                is_list = isinstance(source, list)
+
+                for key, item in enumerate(source) if is_list else source.items():
+                    if isinstance(item, (list, dict)):
+                        item_id = id(item)
+                        rendered = memo.get(item_id)
+
+                        if rendered is None:
+                            rendered = memo[item_id] = [] if isinstance(item, list) else {}
+                            stack.append((item, rendered))
+                    else:
+                        rendered = self.render_value(item, locals_)
+
+                    if is_list:
+                        target.append(rendered)
+                    else:
+                        target[key] = rendered
 
             return result
         elif value is None or isinstance(value, (int, bool)):
@@ -252,30 +333,50 @@ class ConfigMaker:
         else:
             raise ValueError(f"Bad value type {type(value)!r}")
 
-    def add_record(self, record):
-        self._check_record_keys(record)
+    def _merge_layers(self, merge: Tuple[str, ...]) -> Tuple[CIDict, Dict[str, Any]]:
+        """
+        Return the config and vars merged from the named layers
 
-        name, merge, raw_vars = dict_gets(record, 'name', 'merge', 'vars')
+        The result is cached by the names and shared, so it must not be modified.
+        """
+        try:
+            return self._merge_cache[merge]
+        except KeyError:
+            pass
 
         merged_vars = {}
         merged_config = CIDict()
 
-        merge = yaml_str_list(merge)
-
         for lower_name in merge:
             try:
                 lower_layer = self.registry[lower_name]
             except KeyError:
                 raise ValueError(f"Undefined record '{lower_name}'")
             else:
-                merged_config = merge_config(merged_config, lower_layer.config)
+                # Layer configs are already merged, so they hold no None values
+                merged_config._update_cidict(lower_layer.config)
                 merged_vars.update(lower_layer.vars)
 
+        result = self._merge_cache[merge] = merged_config, merged_vars
+        return result
+
+    def add_record(self, record):
+        self._check_record_keys(record)
+
+        name, merge, raw_vars = dict_gets(record, 'name', 'merge', 'vars')
+
+        base_config, base_vars = self._merge_layers(tuple(yaml_str_list(merge)))
+        merged_vars = dict(base_vars)
+        merged_config = CIDict(base_config)
+
+        # Jinja context shared by every substitution below, kept in sync with merged_vars
+        context = {**merged_vars, 'name': name}
+
         if raw_vars:
-            merged_vars.update(self.render_value(raw_vars, {
-                **merged_vars,
-                'name': name,
-            }))
+            rendered_vars = self.render_value(raw_vars, context)
+            merged_vars.update(rendered_vars)
+            context.update(rendered_vars)
+            context['name'] = name
 
         raw_config, raw_host, raw_match = dict_gets(record, 'config', 'host', 'match')
 
@@ -285,28 +386,19 @@ class ConfigMaker:
             if raw_match is not None:
                 raise ValueError('Specifying both host and match is prohibited')
 
-            host = yaml_str_list(self.render_value(raw_host, {
-                **merged_vars,
-                'name': name,
-            }))
+            host = yaml_str_list(self.render_value(raw_host, context))
 
             if not isinstance(host, list):
                 raise ValueError(f'host must be a str or list, got {type(host)!r}')
         elif raw_match is not None:
-            match = normalize_match(self.render_value(raw_match, {
-                **merged_vars,
-                'name': name,
-            }))
+            match = normalize_match(self.render_value(raw_match, context))
 
         config = None
         if raw_config:
             # Substitute values with merged_vars and merged_config
-            config = self.render_value(raw_config, {
-                **merged_vars,
-                'name': name,
-                'host': host,
-                'match': match,
-            })
+            context['host'] = host
+            context['match'] = match
+            config = self.render_value(raw_config, context)
             merged_config = merge_config(merged_config, config)
 
         layer = Layer(
@@ -317,6 +409,10 @@ class ConfigMaker:
         )
 
         if name:
+            if name in self.registry:
+                # Redefining a layer invalidates the merges made with the old one
+                self._merge_cache.clear()
+
             self.registry[name] = layer
 
         if host or match:
@@ -333,21 +429,23 @@ def main():
         'input', nargs='?', default='config.yaml', type=FileType('rb'),
         help='default to %(default)s',
     )
+    p.add_argument(
+        '--jinja-cache', metavar='DIR',
+        help='cache compiled templates in an existing directory across runs',
+    )
 
     args = p.parse_args()
 
-    records = yaml.safe_load(args.input.read())
-    config_maker = ConfigMaker()
+    records = yaml.load(args.input, Loader=SafeLoader)
+    config_maker = ConfigMaker(jinja_cache_dir=args.jinja_cache)
 
     for record in records:
         config_maker.add_record(record)
 
-    with StringIO() as out:
-        for entry in config_maker.entries:
-            entry.write(out)
-
-        args.output.write(out.getvalue())
-        args.output.flush()
+    # Render every entry before writing so that an invalid entry leaves no partial output
+    texts = [entry.render() for entry in config_maker.entries]
+    args.output.writelines(texts)
+    args.output.flush()
 
 
 if __name__ == '__main__':
@@ -1,83 +1,154 @@
 from __future__ import annotations
 
-from typing import TypeVar, MutableMapping, Tuple
+import collections.abc
+from typing import Any, Dict, Generic, ItemsView, Iterator, KeysView, List, Mapping, Optional, Tuple, TypeVar, ValuesView
 
 T = TypeVar('T')
 
+# SSH keywords form a small closed set, so their folded forms are cached
+_FOLD_CACHE: Dict[str, str] = {}
 
-def _missing():
+
+def _fold(key: str, _cache: Dict[str, str] = _FOLD_CACHE) -> str:
+    folded = _cache.get(key)
+    if folded is None:
+        folded = _cache[key] = key.casefold()
+    return folded
+
+
+def _missing() -> None:
     raise AssertionError
 
 
-class CIDict(MutableMapping[str, T]):
+# Registered as a MutableMapping below instead of inheriting from it. A mypyc-compiled subclass would share the ABC
+# registry of MutableMapping, so that isinstance(dict(), CIDict) is True.
+class CIDict(Generic[T]):
     """
     Case-insensitive dict
     """
 
-    def __init__(self, __m=None, **kwargs):
-        self._data = {}
+    def __init__(self, __m: Optional[Mapping[str, T]] = None, **kwargs: T) -> None:
+        # Both are keyed by the folded key and updated together to keep the same order
+        self._keys: Dict[str, str] = {}
+        self._values: Dict[str, T] = {}
 
-        if isinstance(__m, CIDict):
-            self._data.update(__m._data)
-        elif __m:
+        if __m:
             self.update(__m)
 
         if kwargs:
             self.update(kwargs)
 
-    def __setitem__(self, key: str, value: T):
-        self._data[key.casefold()] = (key, value)
+    @classmethod
+    def _from_raw(cls, keys: Dict[str, str], values: Dict[str, T]) -> CIDict[T]:
+        """Wrap data already in the internal form {folded_key: key}, {folded_key: value} without copying"""
+        obj = cls()
+        obj._keys = keys
+        obj._values = values
+        return obj
+
+    def _update_cidict(self, other: CIDict[T]) -> None:
+        """Update from another CIDict without folding its keys again"""
+        self._keys.update(other._keys)
+        self._values.update(other._values)
+
+    def update(self, __m: Any = (), **kwargs: T) -> None:
+        if isinstance(__m, CIDict):
+            self._update_cidict(__m)
+        elif isinstance(__m, collections.abc.Mapping):
+            for key, value in __m.items():
+                self[key] = value
+        else:
+            for key, value in __m:
+                self[key] = value
+
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def __setitem__(self, key: str, value: T) -> None:
+        folded = _fold(key)
+        self._keys[folded] = key
+        self._values[folded] = value
 
-    def __getitem__(self, key: str):
-        return self._data[key.casefold()][1]
+    def __getitem__(self, key: str) -> T:
+        return self._values[_fold(key)]
 
-    def __delitem__(self, key: str):
-        del self._data[key.casefold()]
+    def __delitem__(self, key: str) -> None:
+        folded = _fold(key)
+        del self._values[folded]
+        del self._keys[folded]
 
-    def __iter__(self):
-        for k, _ in self._data.values():
-            yield k
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys.values())
 
-    def __len__(self):
-        return len(self._data)
+    def __len__(self) -> int:
+        return len(self._values)
 
-    def clear(self):
-        self._data.clear()
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and _fold(key) in self._values
 
-    def pop(self, key: str, default=_missing) -> T:
-        pair = self._data.pop(key, None)
-        if pair is None:
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._values.get(_fold(key), default)
+
+    def keys(self) -> KeysView[str]:
+        return collections.abc.KeysView(self)
+
+    def items(self) -> ItemsView[str, T]:
+        return collections.abc.ItemsView(self)
+
+    def values(self) -> ValuesView[T]:
+        return self._values.values()
+
+    def clear(self) -> None:
+        self._keys.clear()
+        self._values.clear()
+
+    def pop(self, key: str, default: Any = _missing) -> T:
+        folded = _fold(key)
+        if folded not in self._values:
             if default is _missing:
                 raise KeyError(key)
             return default
-        return pair[1]
+        del self._keys[folded]
+        return self._values.pop(folded)
 
     def popitem(self) -> Tuple[str, T]:
-        return self._data.popitem()[1]
-
-    def setdefault(self, key: str, default: T = None) -> T:
-        folded = key.casefold()
-        _, v = self._data.setdefault(folded, (key, default))
-        return v
-
-    def __eq__(self, other):
+        _, key = self._keys.popitem()
+        _, value = self._values.popitem()
+        return key, value
+
+    def setdefault(self, key: str, default: Any = None) -> T:
+        folded = _fold(key)
+        if folded not in self._values:
+            self._keys[folded] = key
+            self._values[folded] = default
+        return self._values[folded]
+
+    def __eq__(self, other: object) -> bool:
         if isinstance(other, CIDict):
-            this = {s: t for s, (_, t) in self._data.items()}
-            that = {s: t for s, (_, t) in other._data.items()}
-            return this == that
+            # Folded keys encode the case-insensitive equality, so the value dicts compare directly
+            return self._values == other._values
+        elif isinstance(other, collections.abc.Mapping):
+            return dict(self.items()) == dict(other.items())
         else:
-            return super().__eq__(other)
+            return NotImplemented
+
+    # Mutable, hence unhashable despite defining __eq__
+    __hash__ = None  # type: ignore[assignment]
 
-    def __repr__(self):
+    def __repr__(self) -> str:
         return repr(dict(self))
 
-    def __str__(self):
+    def __str__(self) -> str:
         return str(dict(self))
 
 
-def dict_unpack(mapping, *keys):
+collections.abc.MutableMapping.register(CIDict)
+
+
+def dict_unpack(mapping: Mapping[Any, Any], *keys: Any) -> List[Any]:
     return [mapping[k] for k in keys]
 
 
-def dict_gets(mapping, *keys, default=None):
-    return [mapping.get(k, default) for k in keys]
+def dict_gets(mapping: Mapping[Any, Any], *keys: Any, default: Any = None) -> List[Any]:
+    get = mapping.get
+    return [get(k, default) for k in keys]
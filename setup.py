@@ -1,3 +1,13 @@
+import os
+
 from setuptools import setup
 
-setup()
+ext_modules = []
+
+if os.environ.get('MAKE_SSH_CONFIG_MYPYC'):
+    # Optionally compile the hot CIDict helpers to a C extension
+    from mypyc.build import mypycify
+
+    ext_modules = mypycify(['make_ssh_config/util.py'])
+
+setup(ext_modules=ext_modules)